@@ -1,13 +1,17 @@
-import operator
+import os
 import numpy as np
 
 import matplotlib as mpl
 #mpl.use('Agg')
 import matplotlib.pyplot as plt
 
+import numba
+from numba import njit, prange, cuda
+import multiprocessing
+from threading import BrokenBarrierError
+from multiprocessing.shared_memory import SharedMemory
+
 #from seqpred import *
-from random import sample, choice, random
-from collections import Counter
 from Bio import Align
 from Bio.PDB.PDBParser import PDBParser
 from Bio.SubsMat.MatrixInfo import blosum62
@@ -15,57 +19,301 @@ from Bio.PDB.Polypeptide import PPBuilder
 
 
 alpha = 10
+
+# number of individuals each thread scores together in evaluate_population_by_edge
+EDGE_BLOCK = 32
+
+# evaluate fitness on the GPU when popSize * number of edges exceeds this
+CUDA_THRESHOLD = 100000
+
+# BLOSUM62 as a dense int8 table indexed by AA_TO_IDX, so scoring a residue pair
+# is a single array lookup instead of a call into a PairwiseAligner
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWYBZX*'
+AA_TO_IDX = {aa:i for i, aa in enumerate(AMINO_ACIDS)}
+IDX_TO_AA = np.array(list(AMINO_ACIDS))
+
+def blosum_table():
+    table = np.full((len(AMINO_ACIDS), len(AMINO_ACIDS)), -4, dtype = np.int8)
+    for (a, b), v in blosum62.items():
+        if a in AA_TO_IDX and b in AA_TO_IDX:
+            table[AA_TO_IDX[a], AA_TO_IDX[b]] = table[AA_TO_IDX[b], AA_TO_IDX[a]] = v
+    return table
+
+BLOSUM = blosum_table()
+
+# aligner used to compare the predicted sequence with the real one
+_ALIGNER = Align.PairwiseAligner()
+_ALIGNER.open_gap_score = -10
+_ALIGNER.extend_gap_score = -0.5
+_ALIGNER.substitution_matrix = blosum62
+
+# convert an array of one-letter amino acids to an int8 array of AA_TO_IDX indices
+def encode_seq(seq):
+    seq = np.asarray(seq)
+    codes = [AA_TO_IDX.get(aa, AA_TO_IDX['X']) for aa in seq.ravel()]
+    return np.array(codes, dtype = np.int8).reshape(seq.shape)
+
+# store the overlap positions of each edge as two int32 arrays, 'pu' for the
+# positions in the fragment of edge[0] and 'pv' for those of edge[1]
+def build_edge_tables(G):
+    for edge in G.edges:
+        sameAA = G.edges[edge]['sameAA']
+        G.edges[edge]['pu'] = np.array([pos[0] for pos in sameAA], dtype = np.int32)
+        G.edges[edge]['pv'] = np.array([pos[1] for pos in sameAA], dtype = np.int32)
+
+# alignment score of one individual over all edges, compiled by numba
+# edge_u, edge_v: term ids of the two ends of each edge
+# pu_flat, pv_flat: overlap positions of all edges, edge e owns pu_offsets[e]:pu_offsets[e+1]
+# frag_tables: encoded fragments, frag_tables[t, j] is fragment j of term t (zero padded)
+# frags_count: number of fragments of each term, choosing frags_count[t] means no fragment
+@njit(cache = True, fastmath = True)
+def energy_kernel(individual, edge_u, edge_v, pu_flat, pv_flat, pu_offsets,
+                  frag_tables, frags_count, blosum):
+    score = 0
+    for e in range(edge_u.shape[0]):
+        u = edge_u[e]
+        v = edge_v[e]
+        if individual[u] < frags_count[u] and individual[v] < frags_count[v]:
+            frag_u = frag_tables[u, individual[u]]
+            frag_v = frag_tables[v, individual[v]]
+            for k in range(pu_offsets[e], pu_offsets[e+1]):
+                score += blosum[frag_u[pu_flat[k]], frag_v[pv_flat[k]]]
+    return score/individual.shape[0]
+
+# energy_kernel of every row of the population, edge by edge: inside one parallel region
+# each thread takes a block of EDGE_BLOCK individuals and, for every edge, loads the
+# overlap positions once and scores them for all individuals of its block
+@njit(parallel = True, fastmath = True, boundscheck = False, cache = True)
+def evaluate_population_by_edge(population, edge_u, edge_v, pu_flat, pv_flat, pu_offsets,
+                                frag_tables, frags_count, blosum):
+    popSize = population.shape[0]
+    acc = np.zeros(popSize, dtype = np.int64)
+    for b in prange((popSize + EDGE_BLOCK - 1) // EDGE_BLOCK):
+        lo = b * EDGE_BLOCK
+        hi = min(lo + EDGE_BLOCK, popSize)
+        for e in range(edge_u.shape[0]):
+            u = edge_u[e]
+            v = edge_v[e]
+            pu_e = pu_flat[pu_offsets[e]:pu_offsets[e+1]]
+            pv_e = pv_flat[pu_offsets[e]:pu_offsets[e+1]]
+            for i in range(lo, hi):
+                if population[i, u] < frags_count[u] and population[i, v] < frags_count[v]:
+                    frag_u = frag_tables[u, population[i, u]]
+                    frag_v = frag_tables[v, population[i, v]]
+                    score = 0
+                    for k in range(pu_e.shape[0]):
+                        score += blosum[frag_u[pu_e[k]], frag_v[pv_e[k]]]
+                    acc[i] += score
+    return acc/population.shape[1]
+
+# alignment score of individual i on edge e, one GPU thread per (i, e) pair
+@cuda.jit
+def score_kernel(population, frag_tables, edge_u, edge_v, pu_flat, pv_flat, pu_offsets,
+                 frags_count, blosum, out):
+    i, e = cuda.grid(2)
+    if i < population.shape[0] and e < edge_u.shape[0]:
+        u = edge_u[e]
+        v = edge_v[e]
+        score = 0
+        if population[i, u] < frags_count[u] and population[i, v] < frags_count[v]:
+            for k in range(pu_offsets[e], pu_offsets[e+1]):
+                score += blosum[frag_tables[u, population[i, u], pu_flat[k]],
+                                frag_tables[v, population[i, v], pv_flat[k]]]
+        out[i, e] = score
+
+# sum the per edge scores of each individual and normalise by the number of TERMs
+@cuda.jit
+def reduce_kernel(partial, n_terms, fitness):
+    i = cuda.grid(1)
+    if i < partial.shape[0]:
+        total = 0
+        for e in range(partial.shape[1]):
+            total += partial[i, e]
+        fitness[i] = total/n_terms
+
+# same as evaluate_population_by_edge, all arrays except population must already be on the device
+def evaluate_population_cuda(population, edge_u, edge_v, pu_flat, pv_flat, pu_offsets,
+                             frag_tables, frags_count, blosum):
+    popSize, n_terms = population.shape
+    n_edges = edge_u.shape[0]
+    population_d = cuda.to_device(np.ascontiguousarray(population))
+    partial = cuda.device_array((popSize, n_edges), dtype = np.int32)
+    fitness = cuda.device_array(popSize, dtype = np.float64)
+    
+    threadsperblock = (16, 16)
+    blockspergrid = ((popSize + 15) // 16, (n_edges + 15) // 16)
+    score_kernel[blockspergrid, threadsperblock](population_d, frag_tables, edge_u, edge_v,
+                                                 pu_flat, pv_flat, pu_offsets, frags_count, blosum, partial)
+    reduce_kernel[(popSize + 127) // 128, 128](partial, n_terms, fitness)
+    return fitness.copy_to_host()
+
+# energy_kernel of rows lo..hi of the population, written into fitness
+@njit(cache = True)
+def evaluate_rows(population, lo, hi, fitness, edge_u, edge_v, pu_flat, pv_flat, pu_offsets,
+                  frag_tables, frags_count, blosum):
+    for i in range(lo, hi):
+        fitness[i] = energy_kernel(population[i], edge_u, edge_v, pu_flat, pv_flat, pu_offsets,
+                                   frag_tables, frags_count, blosum)
+
+# long running process scoring its share of the rows of the shared population,
+# the master and all workers meet at barrier before and after each evaluation;
+# a worker that fails aborts the barrier so the master does not wait for it forever
+def fitness_worker(worker_id, n_workers, pop_name, fitness_name, shape, dtype, n_rows, tables, barrier, stop):
+    try:
+        pop_shm = SharedMemory(name = pop_name)
+        fitness_shm = SharedMemory(name = fitness_name)
+        population = np.ndarray(shape, dtype = dtype, buffer = pop_shm.buf)
+        fitness = np.ndarray(shape[0], dtype = np.float64, buffer = fitness_shm.buf)
+        while True:
+            barrier.wait()
+            if stop.is_set():
+                break
+            n = n_rows.value
+            evaluate_rows(population, worker_id * n // n_workers, (worker_id + 1) * n // n_workers, fitness, *tables)
+            barrier.wait()
+    except BrokenBarrierError:
+        return
+    except BaseException:
+        barrier.abort()
+        raise
+    del population, fitness
+    pop_shm.close()
+    fitness_shm.close()
+
+# pool of fitness_worker processes sharing the population and fitness buffers,
+# an alternative to the numba threads of evaluate_population_by_edge; workers are
+# spawned rather than forked, numba's threading layers (TBB) are not fork safe
+class FitnessPool:
+    
+    def __init__(self, n_workers, max_rows, n_genes, dtype, tables):
+        ctx = multiprocessing.get_context('spawn')
+        self.shape = (max_rows, n_genes)
+        self.pop_shm = SharedMemory(create = True, size = max_rows * n_genes * np.dtype(dtype).itemsize)
+        self.fitness_shm = SharedMemory(create = True, size = max_rows * np.dtype(np.float64).itemsize)
+        self.population = np.ndarray(self.shape, dtype = dtype, buffer = self.pop_shm.buf)
+        self.fitness = np.ndarray(max_rows, dtype = np.float64, buffer = self.fitness_shm.buf)
+        self.n_rows = ctx.Value('i', 0)
+        self.barrier = ctx.Barrier(n_workers + 1)
+        self.stop = ctx.Event()
+        self.workers = []
+        for i in range(n_workers):
+            worker = ctx.Process(target = fitness_worker, daemon = True,
+                             args = (i, n_workers, self.pop_shm.name, self.fitness_shm.name,
+                                     self.shape, dtype, self.n_rows, tables, self.barrier, self.stop))
+            worker.start()
+            self.workers.append(worker)
+    
+    def check_workers(self):
+        dead = [worker.exitcode for worker in self.workers if not worker.is_alive()]
+        if dead:
+            self.barrier.abort()
+            raise RuntimeError('fitness worker exited with code %s' % dead[0])
+    
+    def evaluate(self, population):
+        self.check_workers()
+        n = len(population)
+        self.population[:n] = population
+        self.n_rows.value = n
+        try:
+            self.barrier.wait()
+            self.barrier.wait()
+        except BrokenBarrierError:
+            self.check_workers()
+            raise RuntimeError('fitness worker failed')
+        return self.fitness[:n].copy()
+    
+    def close(self):
+        self.stop.set()
+        if all(worker.is_alive() for worker in self.workers) and not self.barrier.broken:
+            try:
+                self.barrier.wait()
+            except BrokenBarrierError:
+                pass
+        else:
+            self.barrier.abort()
+        for worker in self.workers:
+            worker.join(timeout = 10)
+            if worker.is_alive():
+                worker.terminate()
+        del self.population, self.fitness
+        self.pop_shm.close()
+        self.pop_shm.unlink()
+        self.fitness_shm.close()
+        self.fitness_shm.unlink()
    
 ######### Genetic Algorithm #############
 # input: list frag_count, which stores the number of fragments each TERM has
 # output:  list, each element represents the index of randomly chosen sequence
+# workers: if given, evaluate fitness in that many processes instead of numba threads
+# fitness backend: the process pool if workers is given, else the GPU when one is available
+# and popSize * number of edges exceeds CUDA_THRESHOLD, else numba threads on the CPU
 
-def genetic_algorithm(protein, match, popSize, eliteSize, num_points, mutationRate, generations):
+def genetic_algorithm(protein, match, popSize, eliteSize, num_points, mutationRate, generations, workers = None):
     
-    aligner = Align.PairwiseAligner()
-    aligner.open_gap_score = -10
-    aligner.extend_gap_score = -0.5
-    aligner.substitution_matrix = blosum62 
+    # selection keeps eliteSize elites of the population and crossover needs two distinct parents
+    if eliteSize < 1:
+        raise ValueError('eliteSize must be at least 1, got %d' % eliteSize)
+    if eliteSize > popSize:
+        raise ValueError('eliteSize (%d) must not exceed popSize (%d)' % (eliteSize, popSize))
     
-    # generate individual by randomly select one from each TERM's match sequence
-    # output: a numpy array, each element represents the number of selected sequence
-    def create_individual():
-        individual = []
-        for i in protein.terms:
-            individual.append(round(random() * match.frags_count[i]))   
-        return individual
-
-    # create initial population, 
+    # fitness is evaluated by numba threads unless a process pool is used, in which case
+    # the threading layer is left unstarted
+    if not workers:
+        numba.set_num_threads(min(os.cpu_count(), numba.config.NUMBA_NUM_THREADS))
+    build_edge_tables(protein.graph)
+    
+    # encode every TERM's match sequences once into frag_tables[term_id, frag_id, pos]
+    term_to_id = {term:i for i, term in enumerate(protein.terms)}
+    frags_count = np.array([match.frags_count[i] for i in protein.terms], dtype = np.int32)
+    frag_int = [encode_seq(match.seq[i]).reshape(match.frags_count[i], -1) for i in protein.terms]
+    frag_tables = np.zeros((len(protein.terms), frags_count.max(), max(f.shape[1] for f in frag_int)), dtype = np.int8)
+    for t, f in enumerate(frag_int):
+        frag_tables[t, :f.shape[0], :f.shape[1]] = f
+    
+    # genes range over 0..frags_count, use the smallest integer type that holds them
+    pop_dtype = np.uint8 if frags_count.max() < 256 else np.int16
+    
+    # flatten edges and overlap positions into the arrays used by energy_kernel
+    edges = list(protein.graph.edges)
+    edge_u = np.array([term_to_id[edge[0]] for edge in edges], dtype = np.int32)
+    edge_v = np.array([term_to_id[edge[1]] for edge in edges], dtype = np.int32)
+    pu_flat = np.concatenate([protein.graph.edges[edge]['pu'] for edge in edges] + [np.zeros(0, dtype = np.int32)])
+    pv_flat = np.concatenate([protein.graph.edges[edge]['pv'] for edge in edges] + [np.zeros(0, dtype = np.int32)])
+    pu_offsets = np.zeros(len(edges) + 1, dtype = np.int32)
+    pu_offsets[1:] = np.cumsum([len(protein.graph.edges[edge]['pu']) for edge in edges])
+    tables = (edge_u, edge_v, pu_flat, pv_flat, pu_offsets, frag_tables, frags_count, BLOSUM)
+    
+    # large runs are evaluated on the GPU, the tables are copied to the device once
+    use_cuda = not workers and cuda.is_available() and max(popSize, 2 * eliteSize) * len(edges) > CUDA_THRESHOLD
+    if use_cuda:
+        device_tables = tuple(cuda.to_device(a) for a in tables)
+    pool = None
+    
+    # fitness of every individual of the population
+    def evaluate(population):
+        if workers:
+            return pool.evaluate(population)
+        elif use_cuda:
+            return evaluate_population_cuda(population, *device_tables)
+        else:
+            return evaluate_population_by_edge(population, *tables)
+    
+    # create initial population, each gene is drawn uniformly from 0..frags_count,
+    # where frags_count stands for choosing no fragment of that TERM
     # input: size of population
     # output: a 2-dimensional numpy ndarray, each row is an individual
     def initial_population(popSize):
-        population = np.zeros(shape = (popSize,len(protein.terms)),dtype = int)   
-        for i in range(popSize):
-            population[i] = create_individual()       
+        population = (np.random.random((popSize, len(protein.terms))) * (frags_count + 1)).astype(pop_dtype)
         return population
     
     # calculate score for each individual based on the amino acids alignment
     # input: individual
     # output: total alignment score of the input individual
     def compare_aa(individual):   
-        frag_num = dict(zip(protein.terms, individual))
-        frag_seq = {}
-        for i in protein.terms:
-                frag_seq[i] = match.select_frag(i, frag_num[i])      
-
-        score = 0  
-        for edge in protein.graph.edges:
-            if type(frag_seq[edge[0]]) == np.ndarray and type(frag_seq[edge[1]]) == np.ndarray:
-                 for pos in protein.graph.edges[edge]['sameAA']:
-                    u_aa = frag_seq[edge[0]][pos[0]]
-                    v_aa = frag_seq[edge[1]][pos[1]]
-                    score += aligner.score(u_aa, v_aa)
-                    
-        return score/len(protein.terms)
+        return energy_kernel(np.asarray(individual), *tables)
     
     def term_count(individual):
-        sel_frag = dict(zip(protein.terms, individual))    
-        is_null = [sel_frag[i] < match.frags_count[i] for i in protein.terms]
+        is_null = individual < frags_count
         return np.sum(is_null)/len(protein.terms)
     
     def energy(individual):
@@ -73,92 +321,81 @@ def genetic_algorithm(protein, match, popSize, eliteSize, num_points, mutationRa
     #- alpha * term_count(individual) 
                 
     # select elites from children
-    # input: population, size of elites, fragmants, graph that represents topolpgy pf protein
-    # output: individuals who have high score
-    def selection(population, eliteSize):
-        fitnessResults = {}
-        for i in range(len(population)):
-            fitnessResults[i] = energy(population[i])
-    
-        sortedResults = sorted(fitnessResults.items(), key = operator.itemgetter(1), reverse = True)
+    # input: population, size of elites, matingpool (preallocated array of 2 * eliteSize rows)
+    # output: matingpool filled with the elites followed by randomly chosen individuals
+    def selection(population, eliteSize, matingpool):
+        fitness = evaluate(population)
            
-        elites = [i[0] for i in sortedResults[:eliteSize]]   
-        non_elites =  list(np.random.choice(range(len(population)), size = eliteSize))
-        matingpool = np.append(population[elites,:],population[non_elites,:],axis = 0)
+        elites = np.argpartition(-fitness, eliteSize - 1)[:eliteSize]
+        non_elites = np.random.choice(len(population), size = eliteSize)
+        matingpool[:eliteSize] = population[elites]
+        matingpool[eliteSize:] = population[non_elites]
         return matingpool     
         
-    # simulate crossover process between two parents
-    # input: two parents (list), and num_points (the number of points between which crossover happens)
-    # output: child produced by parent1 and parent2       
-    def crossover(parent1, parent2, num_points):
-        points = sample(range(len(parent1)), num_points)
-        points = list(set(points) | {0, len(parent1)})
-        points.sort()
-        child = []
-        for i in range(len(points)-1):
-            provider = choice([parent1, parent2])
-            child.extend(provider[points[i]:points[i+1]])
-        
-        return child
-                
-    # simulate crossover process among population, randomly select two individuals as parents each time
-    # input: matingpool (candidate parents), popSize (size of children), num_points
+    # simulate crossover process among population, randomly select two individuals as parents
+    # for each child, cut both at num_points points and take each segment from either parent
+    # input: matingpool (candidate parents), num_points
     # output: children (2-dimensional array, each row is an individual)
     def crossover_population(matingpool, num_points):
-        children = np.zeros(shape = (matingpool.shape[0], matingpool.shape[1]), dtype = int)
-        for i in range(len(children)):
-            parents = sample(list(matingpool),2)
-            children[i] = crossover(parents[0], parents[1], num_points)
+        popSize, nGenes = matingpool.shape
+        idxA = np.random.randint(0, popSize, size = popSize)
+        idxB = (idxA + np.random.randint(1, popSize, size = popSize)) % popSize
+        parentsA = matingpool[idxA]
+        parentsB = matingpool[idxB]
+        
+        # at each cut point the child switches parent with probability 0.5, which gives every
+        # segment an independent random parent; the parity of the switches so far tells which
+        cuts = np.random.randint(1, nGenes, size = (popSize, num_points))
+        switch = np.zeros((popSize, nGenes), dtype = np.int32)
+        np.add.at(switch, (np.arange(popSize)[:, None], cuts), np.random.randint(0, 2, size = cuts.shape))
+        startA = np.random.random((popSize, 1)) < 0.5
+        mask = startA ^ (np.cumsum(switch, axis = 1) % 2 == 1)
+        
+        children = np.where(mask, parentsA, parentsB)
         return children
     
-    # simulate gene mutation on individual
-    # input: individual, mutationRate (rate of mutation), fragments
-    # output: individual (mutated individual)        
-    def mutate(individual, mutationRate):
-        mutationNumber = int(mutationRate * len(individual))
-        mutationPosition = sample(range(len(individual)),mutationNumber)
-        for i in mutationPosition:
-            individual[i] = choice(range(match.frags_count[protein.terms[i]]))
-        return individual
-    
-    # simulate gene mutation on population
-    # input: population, mutationRate, fragments`
-    # output: mutatePop (mutated population)
-    def mutate_population(population, mutationRate):
-        for i in range(len(population)):
-            population[i] = mutate(population[i], mutationRate)
-            
+    # simulate gene mutation on population, each gene mutates with probability mutationRate
+    # to one of the fragments of its TERM
+    # the population is modified in place, only pass arrays that may be overwritten (children)
+    # input: population, mutationRate
+    # output: population (the same array, mutated)
+    def mutate_population_inplace(population, mutationRate):
+        rows, cols = np.nonzero(np.random.random(population.shape) < mutationRate)
+        population[rows, cols] = (np.random.random(len(cols)) * frags_count[cols]).astype(population.dtype)
         return population
             
     
+    # the mating pool is refilled in place every generation
+    matingpool = np.empty((2 * eliteSize, len(protein.terms)), dtype = pop_dtype)
+    
     def next_generation(population, eliteSize, num_points, mutationRate):
-        matingpool = selection(population, eliteSize)
+        selection(population, eliteSize, matingpool)
         children = crossover_population(matingpool, num_points)
-        nextGeneration = mutate_population(children, mutationRate)
+        nextGeneration = mutate_population_inplace(children, mutationRate)
         return nextGeneration
     
-    # restore to letter form
+    # for each residue, the ids of the TERMs that include it and its position in each of them
+    residue_terms = []
+    residue_pos = []
+    for pos in protein.terms:
+        residue_terms.append(np.array([term_to_id[term] for term in protein.inverse[pos]], dtype = np.int32))
+        residue_pos.append(np.array([protein.neighbors[term].index(pos) for term in protein.inverse[pos]], dtype = np.int32))
+    
+    # restore to letter form, each residue takes the most common amino acid among the
+    # selected fragments that include it
     def restore_seq(individual):
-        possible_aa = list([] for i in protein.terms)            
-        candidate = dict(zip(protein.terms, possible_aa)) # inverse tells us for each residue, which protein.terms include it
-        frag_num = dict(zip(protein.terms, individual)) # predict represents the choice of fragment for each TERM
-        frag_seq = {}
-        for i in protein.terms:
-            frag_seq[i] = match.select_frag(i, frag_num[i]) 
-    
-        for pos in protein.inverse:
-            for term in protein.inverse[pos]:
-                if type(frag_seq[term]) == np.ndarray:
-                    indice = protein.neighbors[term].index(pos)
-                    candidate[pos].append(frag_seq[term][indice])
-
+        individual = np.asarray(individual)
         possible_seq = ''
-        for i in protein.terms:
-            if candidate[i] != []:
-                possible_seq += Counter(candidate[i]).most_common(1)[0][0]
+        for r in range(len(protein.terms)):
+            terms = residue_terms[r]
+            frag_num = individual[terms]
+            selected = frag_num < frags_count[terms]
+            if selected.any():
+                candidate = frag_tables[terms[selected], frag_num[selected], residue_pos[r][selected]]
+                counts = np.bincount(candidate, minlength = len(AMINO_ACIDS))
+                possible_seq += IDX_TO_AA[counts.argmax()]
             else:
                 possible_seq += '-'
-                continue
     
         return possible_seq
     
@@ -172,13 +409,19 @@ def genetic_algorithm(protein, match, popSize, eliteSize, num_points, mutationRa
         return seq
     
     score = []
-    original = real_seq()
-    pop = initial_population(popSize)    
-    for i in range(generations):
-        pop = next_generation(pop, eliteSize, num_points, mutationRate)
-        predict = restore_seq(pop[0])
-       #score.append(energy(pop[0]))
-        score.append(aligner.score(predict, original))   
+    try:
+        if workers:
+            pool = FitnessPool(workers, max(popSize, 2 * eliteSize), len(protein.terms), pop_dtype, tables)
+        original = real_seq()
+        pop = initial_population(popSize)    
+        for i in range(generations):
+            pop = next_generation(pop, eliteSize, num_points, mutationRate)
+            predict = restore_seq(pop[0])
+           #score.append(energy(pop[0]))
+            score.append(_ALIGNER.score(predict, original))   
+    finally:
+        if pool is not None:
+            pool.close()
     
     return score
 '''    
@@ -190,17 +433,11 @@ def genetic_algorithm(protein, match, popSize, eliteSize, num_points, mutationRa
 
 ############# Plot function ###############
 def len_frag(population):
-    len_frags = [protein.match[i].shape[1] for i in protein.terms]
-    nb_frags = [protein.match[i].shape[0] for i in protein.terms]
-    
-    len_frag = 0
-    for individual in population:
-        diff = individual - nb_frags
-        for i in range(len(diff)):
-            if diff[i] < 0:
-                len_frag += len_frags[i]
-                
-    return len_frag/(len(population) * len(protein.match))
+    len_frags = np.array([protein.match[i].shape[1] for i in protein.terms])
+    nb_frags = np.array([protein.match[i].shape[0] for i in protein.terms])
+    
+    selected = population < nb_frags
+    return (selected * len_frags).sum()/(len(population) * len(protein.match))
     
     
 def plot(popSize, eliteSize, num_points, mutationRate, generations):
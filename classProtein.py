@@ -15,10 +15,11 @@ from Bio.PDB.Polypeptide import three_to_one
 path = path = '/Users/pengdandan/Desktop/lab_rotation/LabRotation2/data/2QMT'
 match_path = '/Users/pengdandan/Desktop/lab_rotation/LabRotation2/code/2QMT_designscore/uniq_t1k_'
 
+_RE_DIGITS = re.compile(r'(\d+)')
+
 ## sort string based on the embedded number
 def embedded_numbers(s):
-    re_digits = re.compile(r'(\d+)')
-    pieces = re_digits.split(s)                 
+    pieces = _RE_DIGITS.split(s)                 
     pieces[1::2] = map(int, pieces[1::2])       
     return pieces
  